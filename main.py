@@ -1,25 +1,46 @@
-from fastapi import FastAPI, Form, HTTPException, Depends
+from fastapi import FastAPI, Form, HTTPException, Depends, Query
 from pydantic import BaseModel
 from amazon.paapi import AmazonAPI
-import psycopg2
+from cachetools import TTLCache
+import asyncpg
 import re
+import asyncio
 import os
 import time
 import jwt
+from cryptography.hazmat.primitives.serialization import load_pem_private_key
 import httpx
 from dotenv import load_dotenv
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from typing import Union
-import traceback
+import logging
 
 load_dotenv()
 
+# ルートロガーは変更せず、このアプリのロガーだけ INFO で出力する
+log = logging.getLogger("price_checker")
+log.setLevel(logging.INFO)
+if not log.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter("%(levelname)s:%(name)s:%(message)s"))
+    log.addHandler(_log_handler)
+log.propagate = False
+
 # Amazon 認証情報
 KEY = os.getenv("AMAZON_KEY")
 SECRET = os.getenv("AMAZON_SECRET")
 TAG = os.getenv("AMAZON_TAG")
 COUNTRY = os.getenv("AMAZON_COUNTRY")
 DATABASE_URL = os.getenv("POSTGRES_URL")
+# ワーカー数で割り、全体の接続数を20以内に収める
+DB_POOL_MAX_SIZE = max(2, 20 // int(os.getenv("WEB_CONCURRENCY", "1")))
+
+AMAZON = AmazonAPI(KEY, SECRET, TAG, COUNTRY)
+# PA-API の取得結果キャッシュ（ASINの組み合わせ単位、5分）
+_paapi_cache = TTLCache(maxsize=1024, ttl=300)
+# 取得中の PA-API 呼び出し（同じASINの組み合わせの同時リクエストで共有）
+_inflight: dict[tuple, asyncio.Future] = {}
 
 # push通知用認証情報
 TEAM_ID = os.getenv("TEAM_ID")
@@ -27,12 +48,12 @@ KEY_ID = os.getenv("KEY_ID")
 BUNDLE_ID = os.getenv("BUNDLE_ID")
 AUTH_KEY_PATH = os.getenv("AUTH_KEY_PATH")
 
-# Render上で、かつ KEY_P8 が存在する場合のみファイル生成
-if os.getenv("RENDER") and os.getenv("KEY_P8"):
-    with open(AUTH_KEY_PATH, "w") as f:
-        f.write(os.getenv("KEY_P8").replace("\\n", "\n"))
+# APNs プロバイダートークン（Appleは60分まで再利用可、45分で更新）
+APNS_TOKEN_TTL = 2700
+_APNS_KEY = None
+_apns_token_cache = {"token": None, "iat": 0}
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -61,50 +82,112 @@ class DeviceTokenRequest(BaseModel):
     user_id: str
     token: str
 
-# DB接続
-conn = psycopg2.connect(DATABASE_URL)
-cursor = conn.cursor()
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS products (
-    id SERIAL PRIMARY KEY,
-    user_id TEXT,
-    asin TEXT,
-    title TEXT,
-    price REAL,
-    url TEXT,
-    target_price REAL
-);
-''')
-conn.commit()
-
-# Create Table for store Device Token
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS device_tokens (
-    user_id TEXT PRIMARY KEY,
-    token TEXT
-);
-''')
-conn.commit()
+# 起動時DDL用のアドバイザリロックのキー
+DDL_LOCK_KEY = 7426001
+
+@app.on_event("startup")
+async def startup():
+    global _APNS_KEY
+    # 秘密鍵は起動時に一度だけパースしておく
+    # KEY_P8 があれば環境変数から直接読み、なければ AUTH_KEY_PATH のファイルを使う
+    try:
+        if os.getenv("KEY_P8"):
+            _APNS_KEY = load_pem_private_key(os.getenv("KEY_P8").replace("\\n", "\n").encode(), password=None)
+        elif AUTH_KEY_PATH and os.path.exists(AUTH_KEY_PATH):
+            with open(AUTH_KEY_PATH, "rb") as f:
+                _APNS_KEY = load_pem_private_key(f.read(), password=None)
+    except Exception as e:
+        # 鍵が不正でもAPI全体は起動させ、通知時にエラーを返す
+        log.error("APNs認証キーの読み込みに失敗: %s", e)
+        _APNS_KEY = None
+    app.state.apns_token_lock = asyncio.Lock()
+    # APNs への同時送信数の上限
+    app.state.apns_semaphore = asyncio.Semaphore(32)
+    # APNs への HTTP/2 接続を通知間で使い回す
+    app.state.apns = httpx.AsyncClient(
+        http2=True,
+        base_url="https://api.push.apple.com",
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+        timeout=10.0,
+    )
+
+    # DB接続（ワーカープロセスごとのコネクションプール、リクエスト間で共有）
+    # PgBouncer（transaction mode）経由の場合は PG_STATEMENT_CACHE_SIZE=0 を指定
+    app.state.pool = await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=2,
+        max_size=DB_POOL_MAX_SIZE,
+        statement_cache_size=int(os.getenv("PG_STATEMENT_CACHE_SIZE", "100")),
+    )
+
+    async with app.state.pool.acquire() as conn:
+        # 複数ワーカーが同時にDDLを実行するとシステムカタログの重複エラーになるため直列化
+        await conn.execute("SELECT pg_advisory_lock($1)", DDL_LOCK_KEY)
+        try:
+            await conn.execute('''
+            CREATE TABLE IF NOT EXISTS products (
+                id SERIAL PRIMARY KEY,
+                user_id TEXT,
+                asin TEXT,
+                title TEXT,
+                price DOUBLE PRECISION,
+                url TEXT,
+                target_price DOUBLE PRECISION
+            );
+            ''')
+            # 最終価格取得日時（1時間以内ならPA-APIを呼ばずDBの価格を使う）
+            await conn.execute("ALTER TABLE products ADD COLUMN IF NOT EXISTS last_checked TIMESTAMPTZ")
+            # REAL では 19.99 などの価格が正確に保持できないため DOUBLE PRECISION に移行
+            price_type = await conn.fetchval(
+                "SELECT data_type FROM information_schema.columns WHERE table_name = 'products' AND column_name = 'price'"
+            )
+            if price_type == "real":
+                await conn.execute(
+                    "ALTER TABLE products ALTER COLUMN price TYPE DOUBLE PRECISION, ALTER COLUMN target_price TYPE DOUBLE PRECISION"
+                )
+            # ユーザー単位の検索用インデックス
+            # (user_id, asin): 重複チェック・削除・ON CONFLICT 用
+            # (user_id, id): 一覧取得のページネーション用
+            # 旧実装で重複登録された行があるとインデックス作成に失敗するため、初回のみ古い行を残して削除
+            if await conn.fetchval("SELECT to_regclass('idx_products_user_asin') IS NULL"):
+                await conn.execute("DELETE FROM products a USING products b WHERE a.user_id = b.user_id AND a.asin = b.asin AND a.id > b.id")
+            await conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_products_user_asin ON products (user_id, asin)")
+            await conn.execute("CREATE INDEX IF NOT EXISTS idx_products_user ON products (user_id, id)")
+
+            # Create Table for store Device Token
+            await conn.execute('''
+            CREATE TABLE IF NOT EXISTS device_tokens (
+                user_id TEXT PRIMARY KEY,
+                token TEXT
+            );
+            ''')
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", DDL_LOCK_KEY)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await app.state.apns.aclose()
+    await app.state.pool.close()
 
 # 全ユーザーの登録商品価格チェック
 # renderで定期実行
 @app.post("/run_check_all")
 async def run_check_all():
-    cursor.execute("SELECT DISTINCT user_id FROM device_tokens")
-    users = cursor.fetchall()
+    async with app.state.pool.acquire() as conn:
+        users = await conn.fetch("SELECT user_id, token FROM device_tokens")
 
-    results = []
-    for (user_id,) in users:
+    pushes = []
+    for user_id, token in users:
         # check_prices() 関数の流用
-        notifications = check_prices(CheckPriceRequest(user_id=user_id))["notifications"]
+        notifications = (await check_prices(CheckPriceRequest(user_id=user_id)))["notifications"]
         if notifications:
-            cursor.execute("SELECT token FROM device_tokens WHERE user_id = %s", (user_id,))
-            token = cursor.fetchone()[0]
             message = f"{len(notifications)}件の商品が買い時です！"
-            # send_notification関数を使って通知
-            await send_notification(NotificationRequest(token=token, message=message))
-            results.append({"user_id": user_id, "notified": True})
+            pushes.append((user_id, token, message))
+
+    # send_notification関数を使ってまとめて通知
+    sent = await send_notifications([(token, message) for _, token, message in pushes])
+    results = [{"user_id": user_id, "notified": not isinstance(r, Exception)} for (user_id, _, _), r in zip(pushes, sent)]
 
     return {"results": results}
 
@@ -118,17 +201,16 @@ async def run_check():
 
 
 async def check_and_notify():
-    cursor.execute("""
-        SELECT user_id, asin, title, target_price, url FROM products
-    """)
-    rows = cursor.fetchall()
+    async with app.state.pool.acquire() as conn:
+        rows = await conn.fetch("""
+            SELECT user_id, asin, title, target_price, url FROM products
+        """)
 
     if not rows:
         return
 
     asin_set = {r[1] for r in rows}
-    amazon = AmazonAPI(KEY, SECRET, TAG, COUNTRY)
-    products = amazon.get_items(item_id_type="ASIN", item_ids=list(asin_set))
+    products = await get_items_cached(asin_set)
 
     user_notifications = {}
 
@@ -142,47 +224,56 @@ async def check_and_notify():
                     user_notifications[user_id] = []
                 user_notifications[user_id].append(f"🛒 {title} が買い時です！（{int(current_price)}円）")
         except Exception as e:
-            print(f"価格取得失敗: {asin}, エラー: {e}")
+            log.warning("価格取得失敗: %s, エラー: %s", asin, e)
+
+    if not user_notifications:
+        return
+
+    async with app.state.pool.acquire() as conn:
+        tokens = await conn.fetch("SELECT user_id, token FROM device_tokens WHERE user_id = ANY($1::text[])", list(user_notifications))
 
-    for user_id, messages in user_notifications.items():
-        cursor.execute("SELECT token FROM device_tokens WHERE user_id = %s", (user_id,))
-        row = cursor.fetchone()
-        if row:
-            token = row[0]
-            message = "\n".join(messages)
-            await send_notification(NotificationRequest(token=token, message=message))
+    await send_notifications([(token, "\n".join(user_notifications[user_id])) for user_id, token in tokens if token])
 
 
 
 @app.post("/register_token")
-def register_token(req: DeviceTokenRequest):
-    cursor.execute("INSERT INTO device_tokens (user_id, token) VALUES (%s, %s) ON CONFLICT (user_id) DO UPDATE SET token = EXCLUDED.token", (req.user_id, req.token))
-    conn.commit()
+async def register_token(req: DeviceTokenRequest):
+    async with app.state.pool.acquire() as conn:
+        await conn.execute("INSERT INTO device_tokens (user_id, token) VALUES ($1, $2) ON CONFLICT (user_id) DO UPDATE SET token = EXCLUDED.token", req.user_id, req.token)
     return {"message": "✅ トークンを登録しました"}
 
 
 # ユーザーIDから取得したトークンを使って通知
 @app.post("/notify_user")
 async def notify_user(user_id: str, message: str):
-    cursor.execute("SELECT token FROM device_tokens WHERE user_id = %s", (user_id,))
-    row = cursor.fetchone()
-    if not row:
+    async with app.state.pool.acquire() as conn:
+        token = await conn.fetchval("SELECT token FROM device_tokens WHERE user_id = $1", user_id)
+    if token is None:
         raise HTTPException(status_code=404, detail="トークンが登録されていません")
     
-    token = row[0]
-    print("--debug token--")
-    print(token)
+    log.debug("debug token: %s", token)
     return await send_notification(NotificationRequest(token=token, message=message))
 
 
+async def get_apns_token() -> str:
+    now = int(time.time())
+    if now - _apns_token_cache["iat"] <= APNS_TOKEN_TTL:
+        return _apns_token_cache["token"]
+
+    async with app.state.apns_token_lock:
+        # 待機中に他のリクエストが更新済みならそれを使う
+        if now - _apns_token_cache["iat"] > APNS_TOKEN_TTL:
+            if _APNS_KEY is None:
+                raise RuntimeError(f"APNs認証キーが読み込まれていません: {AUTH_KEY_PATH}")
+            token = jwt.encode({"iss": TEAM_ID, "iat": now}, _APNS_KEY, algorithm="ES256", headers={"alg": "ES256", "kid": KEY_ID})
+            _apns_token_cache.update(token=token, iat=now)
+        return _apns_token_cache["token"]
+
+
 @app.post("/notify")
 async def send_notification(data: NotificationRequest):
     try:
-        with open(AUTH_KEY_PATH) as f:
-            secret = f.read()
-
-        now = int(time.time())
-        token = jwt.encode({"iss": TEAM_ID, "iat": now}, secret, algorithm="ES256", headers={"alg": "ES256", "kid": KEY_ID})
+        token = await get_apns_token()
 
         headers = {
             "authorization": f"bearer {token}",
@@ -198,119 +289,217 @@ async def send_notification(data: NotificationRequest):
             }
         }
 
-        async with httpx.AsyncClient(http2=True) as client:
-            res = await client.post(f"https://api.push.apple.com/3/device/{data.token}", json=payload, headers=headers)
+        res = await app.state.apns.post(f"/3/device/{data.token}", json=payload, headers=headers)
 
-            print(f"🔁 Status Code: {res.status_code}")
-            print(f"📨 Response: {res.text}")
-            print(f"📨 Headers: {res.headers}")
+        log.debug("APNs status %s", res.status_code)
 
-            if res.status_code == 200:
-                return {"status": "✅ 通知送信成功"}
-            raise HTTPException(status_code=500, detail=f"APNs Error: {res.text}")
+        if res.status_code == 200:
+            return {"status": "✅ 通知送信成功"}
 
+        # プロキシのHTMLエラーなどJSONでない応答もあるため、失敗時は None とする
+        try:
+            body = res.json()
+        except ValueError:
+            body = None
+        reason = body.get("reason") if isinstance(body, dict) else None
+        log.warning("APNs error %s: %s", res.status_code, reason)
+
+        # 無効になったトークンは削除して以降の送信を止める
+        if res.status_code == 410 or reason == "BadDeviceToken":
+            async with app.state.pool.acquire() as conn:
+                await conn.execute("DELETE FROM device_tokens WHERE token = $1", data.token)
+        raise HTTPException(status_code=500, detail=f"APNs Error: {res.status_code} {reason}")
+
+    except HTTPException:
+        # APNs のエラー応答は上で記録済みのためそのまま返す
+        raise
     except Exception as e:
-        print("通知送信エラー:", e)
-        traceback.print_exc()
+        log.exception("通知送信エラー: %s", e)
         raise HTTPException(status_code=500, detail=f"❌ 通知送信失敗: {str(e)}")
 
+
+# 複数の通知を同じHTTP/2接続上で並行送信
+async def send_notifications(pushes):
+    async def send(token, message):
+        async with app.state.apns_semaphore:
+            return await send_notification(NotificationRequest(token=token, message=message))
+
+    return await asyncio.gather(*(send(token, message) for token, message in pushes), return_exceptions=True)
+
+
+# PA-API SDK は同期処理のため、スレッドで実行してイベントループを塞がない
+async def get_items_cached(asins):
+    key = tuple(sorted(asins))
+    while True:
+        products = _paapi_cache.get(key)
+        if products is not None:
+            return products
+
+        # 同じASINの組み合わせを取得中なら、その結果を待つ
+        fut = _inflight.get(key)
+        if fut is None:
+            break
+        try:
+            return await asyncio.shield(fut)
+        except asyncio.CancelledError:
+            # 取得側がキャンセルされただけなら、自分が取得し直す
+            if not fut.cancelled():
+                raise
+
+    fut = asyncio.get_running_loop().create_future()
+    _inflight[key] = fut
+    try:
+        products = await asyncio.to_thread(AMAZON.get_items, item_id_type="ASIN", item_ids=list(key))
+        if products["data"]:
+            _paapi_cache[key] = products
+        fut.set_result(products)
+        return products
+    except Exception as e:
+        fut.set_exception(e)
+        # 待機中の呼び出しがなくても警告を出さないよう取得済みにする
+        fut.exception()
+        raise
+    finally:
+        del _inflight[key]
+        # 取得側がキャンセルされた場合も待機中の呼び出しを解放する
+        if not fut.done():
+            fut.cancel()
+
+_ASIN_RE = re.compile(r"/(?:dp|gp/product)/([A-Z0-9]{10})")
+
 def extract_asin(url: str) -> Union[str, None]:
-    match = re.search(r"/(?:dp|gp/product)/([A-Z0-9]{10})", url)
+    match = _ASIN_RE.search(url)
     return match.group(1) if match else None
 
 @app.post("/bulk_register")
-def bulk_register(req: BulkRegisterRequest):
-    cursor.execute("SELECT COUNT(*) FROM products WHERE user_id = %s", (req.user_id,))
-    current_count = cursor.fetchone()[0]
+async def bulk_register(req: BulkRegisterRequest):
+    async with app.state.pool.acquire() as conn:
+        current_count = await conn.fetchval("SELECT COUNT(*) FROM products WHERE user_id = $1", req.user_id)
     if current_count + len(req.items) > 10:
         return {"error": f"登録できるのは最大10件までです。現在: {current_count}件"}
 
-    asin_map = {extract_asin(item.url): item for item in req.items if extract_asin(item.url)}
+    asin_map = {}
+    for item in req.items:
+        asin = extract_asin(item.url)
+        if asin:
+            asin_map[asin] = item
     asin_list = list(asin_map.keys())
-    amazon = AmazonAPI(KEY, SECRET, TAG, COUNTRY)
-    products = amazon.get_items(item_id_type="ASIN", item_ids=asin_list)
+
+    async def fetch_existing():
+        async with app.state.pool.acquire() as conn:
+            rows = await conn.fetch("SELECT asin FROM products WHERE user_id = $1 AND asin = ANY($2::text[])", req.user_id, asin_list)
+        return {r[0] for r in rows}
+
+    # 登録済みASINの確認とPA-API呼び出しを並行実行
+    products, existing = await asyncio.gather(get_items_cached(asin_list), fetch_existing())
     if not products["data"]:
         return {"error": "Amazonから商品情報を取得できませんでした"}
 
     results = []
+    rows = []
     for asin in asin_list:
         try:
+            if asin in existing:
+                results.append({"asin": asin, "message": "すでに登録済みのためスキップ"})
+                continue
+
             item = products["data"][asin]
             title = item.item_info.title.display_value
-            price = int(item.offers.listings[0].price.amount)
+            price = item.offers.listings[0].price.amount
             url = item.detail_page_url
             target_price = asin_map[asin].target_price
 
-            cursor.execute("SELECT COUNT(*) FROM products WHERE user_id = %s AND asin = %s", (req.user_id, asin))
-            if cursor.fetchone()[0] > 0:
-                results.append({"asin": asin, "message": "すでに登録済みのためスキップ"})
-                continue
-
-            cursor.execute('''
-                INSERT INTO products (user_id, asin, title, price, url, target_price)
-                VALUES (%s, %s, %s, %s, %s, %s)
-            ''', (req.user_id, asin, title, price, url, target_price))
-            results.append({"asin": asin, "title": title, "current_price": price})
+            # DBには切り捨てずに保存（check_prices で比較に使うため）
+            rows.append((req.user_id, asin, title, price, url, target_price))
+            results.append({"asin": asin, "title": title, "current_price": int(price)})
 
         except Exception as e:
             results.append({"asin": asin, "error": f"処理中にエラー: {str(e)}"})
 
-    conn.commit()
+    if rows:
+        async with app.state.pool.acquire() as conn:
+            await conn.executemany('''
+                INSERT INTO products (user_id, asin, title, price, url, target_price, last_checked)
+                VALUES ($1, $2, $3, $4, $5, $6, NOW())
+                ON CONFLICT (user_id, asin) DO NOTHING
+            ''', rows)
+
     return {"message": f"{len(results)}件登録完了", "items": results}
 
 @app.get("/products/{user_id}")
-def get_products(user_id: str):
-    cursor.execute("SELECT asin, title, price, url, target_price FROM products WHERE user_id = %s", (user_id,))
-    rows = cursor.fetchall()
-    return {"items": [{"asin": r[0], "title": r[1], "current_price": r[2], "url": r[3], "target_price": r[4]} for r in rows]}
+async def get_products(user_id: str, limit: int = Query(50, ge=1, le=100), after_id: Union[int, None] = Query(None, ge=0, le=2**31 - 1)):
+    # id をカーソルにしたキーセットページネーション
+    async with app.state.pool.acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT id, asin, title, price, url, target_price FROM products WHERE user_id = $1 AND ($2::int IS NULL OR id > $2) ORDER BY id LIMIT $3",
+            user_id, after_id, limit,
+        )
+    next_cursor = rows[-1][0] if len(rows) == limit else None
+    return {
+        "items": [{"asin": r[1], "title": r[2], "current_price": r[3], "url": r[4], "target_price": r[5]} for r in rows],
+        "next_cursor": next_cursor,
+    }
 
 @app.delete("/product")
-def delete_product(user_id: str, asin: str):
-    cursor.execute("SELECT COUNT(*) FROM products WHERE user_id = %s AND asin = %s", (user_id, asin))
-    if cursor.fetchone()[0] == 0:
+async def delete_product(user_id: str, asin: str):
+    async with app.state.pool.acquire() as conn:
+        deleted = await conn.fetchval("DELETE FROM products WHERE user_id = $1 AND asin = $2 RETURNING 1", user_id, asin)
+    if deleted is None:
         raise HTTPException(status_code=404, detail="該当の商品が見つかりません")
-    cursor.execute("DELETE FROM products WHERE user_id = %s AND asin = %s", (user_id, asin))
-    conn.commit()
     return {"message": f"ASIN {asin} を削除しました"}
 
 @app.get("/debug_tokens")
-def debug_tokens():
-    cursor.execute("SELECT user_id, token FROM device_tokens")
-    return {"tokens": cursor.fetchall()}
+async def debug_tokens():
+    async with app.state.pool.acquire() as conn:
+        rows = await conn.fetch("SELECT user_id, token FROM device_tokens")
+    return {"tokens": [list(r) for r in rows]}
 
 @app.get("/debug_users")
-def debug_users():
-    cursor.execute("SELECT DISTINCT user_id FROM products")
-    return {"user_ids": [r[0] for r in cursor.fetchall()]}
+async def debug_users():
+    async with app.state.pool.acquire() as conn:
+        rows = await conn.fetch("SELECT DISTINCT user_id FROM products")
+    return {"user_ids": [r[0] for r in rows]}
 
 
 @app.post("/check_prices")
-def check_prices(req: CheckPriceRequest):
-    cursor.execute("SELECT asin, title, target_price, url FROM products WHERE user_id = %s", (req.user_id,))
-    rows = cursor.fetchall()
+async def check_prices(req: CheckPriceRequest):
+    async with app.state.pool.acquire() as conn:
+        rows = await conn.fetch("""
+            SELECT asin, title, price, target_price, url,
+                   (last_checked IS NULL OR last_checked < NOW() - INTERVAL '1 hour') AS stale
+            FROM products WHERE user_id = $1
+        """, req.user_id)
     if not rows:
         return {"notifications": []}
 
-    asin_list = [r[0] for r in rows]
-    asin_to_target = {r[0]: {"title": r[1], "target_price": r[2], "url": r[3]} for r in rows}
-    amazon = AmazonAPI(KEY, SECRET, TAG, COUNTRY)
-    products = amazon.get_items(item_id_type="ASIN", item_ids=asin_list)
+    # 1時間以内に取得済みの商品はDBの価格を使い、古いものだけPA-APIで更新
+    current_prices = {r["asin"]: r["price"] for r in rows if not r["stale"]}
+    stale_asins = [r["asin"] for r in rows if r["stale"]]
+    if stale_asins:
+        products = await get_items_cached(stale_asins)
+        updates = []
+        for asin in stale_asins:
+            try:
+                item = products["data"][asin]
+                current_prices[asin] = item.offers.listings[0].price.amount
+                updates.append((current_prices[asin], req.user_id, asin))
+            except Exception as e:
+                log.warning("エラー: %s: %s", asin, e)
+        if updates:
+            async with app.state.pool.acquire() as conn:
+                await conn.executemany("UPDATE products SET price = $1, last_checked = NOW() WHERE user_id = $2 AND asin = $3", updates)
 
     notifications = []
-    for asin in asin_list:
-        try:
-            item = products["data"][asin]
-            current_price = item.offers.listings[0].price.amount
-            target_price = asin_to_target[asin]["target_price"]
-            if current_price <= target_price:
-                notifications.append({
-                    "asin": asin,
-                    "title": asin_to_target[asin]["title"],
-                    "current_price": current_price,
-                    "target_price": target_price,
-                    "url": asin_to_target[asin]["url"]
-                })
-        except Exception as e:
-            print(f"エラー: {asin}: {e}")
+    for row in rows:
+        asin = row["asin"]
+        current_price = current_prices.get(asin)
+        if current_price is not None and current_price <= row["target_price"]:
+            notifications.append({
+                "asin": asin,
+                "title": row["title"],
+                "current_price": current_price,
+                "target_price": row["target_price"],
+                "url": row["url"]
+            })
 
     return {"notifications": notifications}